@@ -0,0 +1,295 @@
+import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
+from openai import OpenAI
+from anthropic import Anthropic
+import json
+import re
+import time
+from datetime import timedelta
+import cassette
+
+# ----------------------------------------------------------------------
+# FUNZIONE GENERICA DI CHIAMATA AI (indipendente da Streamlit)
+# ----------------------------------------------------------------------
+SYSTEM_PROMPT = "Sei un esperto creativo di team building."
+
+PROVIDERS = ["Google Gemini", "ChatGPT", "Claude (Anthropic)", "Groq", "Grok (xAI)"]
+
+# Mappa Provider → nome della chiave (secrets.toml o variabile d'ambiente)
+API_KEY_NAMES = {
+    "Google Gemini": "GOOGLE_API_KEY",
+    "ChatGPT": "OPENAI_API_KEY",
+    "Claude (Anthropic)": "ANTHROPIC_API_KEY",
+    "Groq": "GROQ_API_KEY",
+    "Grok (xAI)": "XAI_API_KEY",
+}
+
+def clean_json_text(text):
+    """Pulisce la stringa JSON da markdown extra."""
+    text = text.strip()
+    if "###OUTPUT_JSON_START###" in text:
+        text = text.split("###OUTPUT_JSON_START###")[1]
+    if "###OUTPUT_JSON_END###" in text:
+        text = text.split("###OUTPUT_JSON_END###")[0]
+    # Rimuovi ```json e ```
+    text = re.sub(r'^```json\s*', '', text)
+    text = re.sub(r'^```\s*', '', text)
+    text = re.sub(r'\s*```$', '', text)
+    return text.strip()
+
+def _merge_turns(turns):
+    """Unisce turni consecutivi con lo stesso ruolo (Claude e Gemini vogliono user/assistant alternati)."""
+    merged = []
+    for turn in turns:
+        if merged and merged[-1]["role"] == turn["role"]:
+            merged[-1] = {"role": turn["role"],
+                          "content": merged[-1]["content"] + "\n\n" + turn["content"]}
+        else:
+            merged.append(dict(turn))
+    return merged
+
+
+# Context caching Gemini: sotto questa soglia la cache esplicita non è ammessa
+GEMINI_CACHE_MIN_TOKENS = 32768
+GEMINI_CACHE_TTL = timedelta(minutes=30)
+# A meno di così dalla scadenza il TTL della cache viene rinnovato prima dell'uso
+GEMINI_CACHE_REFRESH_S = 300
+
+# Modelli Gemini che rifiutano il system_instruction (gemma-*, modelli più vecchi)
+_GEMINI_NO_SYSTEM_INSTRUCTION = set()
+
+
+class ChatSession:
+    """
+    Stato lato provider di una conversazione multi-turno (es. Fase 2).
+    La trascrizione resta la history dell'app (commenti utente + risposte), con
+    l'istruzione del turno solo sull'ultimo messaggio: il prefisso resta stabile tra
+    un turno e l'altro. La sessione conserva la cache Gemini di quel prefisso e
+    abilita i breakpoint di cache di Claude.
+    """
+
+    def __init__(self):
+        self.gemini_cache = None          # {"model", "contents", "handle", "expires"}
+        self.gemini_cache_disabled = False
+
+    def close(self):
+        """Elimina la cache Gemini della conversazione (altrimenti scade col TTL)."""
+        if self.gemini_cache:
+            try:
+                self.gemini_cache["handle"].delete()
+            except Exception as e:
+                print(f"Gemini cache delete error: {e}")
+            self.gemini_cache = None
+
+
+def _chars(contents):
+    return sum(len(part) for c in contents for part in c["parts"])
+
+
+def _cached_handle(session, model_id, prefix):
+    """Handle della cache della sessione se copre l'inizio di `prefix`, con TTL rinnovato se in scadenza."""
+    cached = session.gemini_cache
+    if not (cached and cached["model"] == model_id
+            and prefix[:len(cached["contents"])] == cached["contents"]):
+        return None
+    if cached["expires"] - time.monotonic() < GEMINI_CACHE_REFRESH_S:
+        try:
+            cached["handle"].update(ttl=GEMINI_CACHE_TTL)
+        except Exception as e:
+            # Cache già scaduta o eliminata: verrà ricreata
+            print(f"Gemini cache scaduta per {model_id}: {e}")
+            session.gemini_cache = None
+            return None
+        cached["expires"] = time.monotonic() + GEMINI_CACHE_TTL.total_seconds()
+    return cached["handle"]
+
+
+def _gemini_model(model_id, system, contents, session):
+    """
+    Modello Gemini e contents da inviare. In una sessione lunga il prefisso della
+    conversazione (tutto tranne l'ultimo turno) va in context cache e si inviano
+    solo i turni successivi; se la cache non è disponibile si invia tutto.
+    """
+    model = genai.GenerativeModel(model_id, system_instruction=system)
+    if session is None or session.gemini_cache_disabled or len(contents) < 2:
+        return model, contents
+
+    prefix = contents[:-1]
+    handle = _cached_handle(session, model_id, prefix)
+    if handle is not None:
+        tail = contents[len(session.gemini_cache["contents"]):]
+        # Stima grossolana (>= 1 carattere per token): si ricrea solo se il
+        # pezzo non in cache potrebbe bastare da solo per una nuova cache
+        if _chars(tail[:-1]) < GEMINI_CACHE_MIN_TOKENS:
+            return genai.GenerativeModel.from_cached_content(cached_content=handle), tail
+
+    if _chars(prefix) < GEMINI_CACHE_MIN_TOKENS:
+        return model, contents
+    try:
+        if model.count_tokens(prefix).total_tokens < GEMINI_CACHE_MIN_TOKENS:
+            return model, contents
+        handle = genai.caching.CachedContent.create(
+            model=f"models/{model_id}", system_instruction=system,
+            contents=prefix, ttl=GEMINI_CACHE_TTL,
+        )
+    except Exception as e:
+        message = str(e).lower()
+        if "not supported" in message or "does not support" in message:
+            # Il modello non ammette il caching: inutile riprovare in questa conversazione
+            session.gemini_cache_disabled = True
+        # Altri errori (quota, rete...) saltano la cache solo per questo turno
+        print(f"Gemini cache non disponibile per {model_id}: {e}")
+        return model, contents
+    session.close()
+    session.gemini_cache = {"model": model_id, "contents": prefix, "handle": handle,
+                            "expires": time.monotonic() + GEMINI_CACHE_TTL.total_seconds()}
+    return genai.GenerativeModel.from_cached_content(cached_content=handle), contents[-1:]
+
+
+def _gemini_generate(model_id, system, contents, session):
+    """generate_content con la cache della sessione; se la cache non esiste più si riprova senza."""
+    model, to_send = _gemini_model(model_id, system, contents, session)
+    try:
+        return model.generate_content(to_send)
+    except (google_exceptions.NotFound, google_exceptions.PermissionDenied) as e:
+        if to_send is contents:
+            raise
+        print(f"Gemini cache non più valida per {model_id}: {e}")
+        session.gemini_cache = None
+        return genai.GenerativeModel(model_id, system_instruction=system).generate_content(contents)
+
+
+def _inline_system(system, contents):
+    """Per i modelli senza system_instruction il system prompt apre il primo turno utente."""
+    first = contents[0]
+    return [{"role": first["role"], "parts": [f"{system}\n\n{first['parts'][0]}"] + first["parts"][1:]}] + contents[1:]
+
+
+@cassette.recordable("ai.complete", ignore=("session",))
+def _complete(provider, model_id, api_key, messages, session=None):
+    """
+    Chiamata grezza al provider con turni strutturati (system + user/assistant).
+    Restituisce {"text": ..., "blocked": ...} (serializzabile, così da poter essere
+    registrata nella cassetta). Con una `ChatSession` il prefisso della conversazione
+    viene messo in cache dove il provider lo consente.
+    """
+    # ---------- OPENAI‑compatible (ChatGPT, Groq, Grok) ----------
+    if provider in ["ChatGPT", "Groq", "Grok (xAI)"]:
+        base_url = None
+        if provider == "Groq":
+            base_url = "https://api.groq.com/openai/v1"
+        elif provider == "Grok (xAI)":
+            base_url = "https://api.x.ai/v1"
+
+        client = OpenAI(api_key=api_key, base_url=base_url)
+        response = client.chat.completions.create(
+            model=model_id,
+            messages=messages
+        )
+        return {"text": response.choices[0].message.content, "blocked": None}
+
+    # ---------- GOOGLE GEMINI ----------
+    elif provider == "Google Gemini":
+        genai.configure(api_key=api_key)
+        # System prompt nativo + contents con ruoli (Gemini chiama "model" l'assistente)
+        contents = [{"role": "model" if m["role"] == "assistant" else "user", "parts": [m["content"]]}
+                    for m in messages[1:]]
+        system = messages[0]['content']
+        if model_id in _GEMINI_NO_SYSTEM_INSTRUCTION:
+            response = _gemini_generate(model_id, None, _inline_system(system, contents), session)
+        else:
+            try:
+                response = _gemini_generate(model_id, system, contents, session)
+            except google_exceptions.InvalidArgument as e:
+                # gemma-* e modelli più vecchi: "Developer instruction is not enabled"
+                if "instruction is not enabled" not in str(e).lower():
+                    raise
+                _GEMINI_NO_SYSTEM_INSTRUCTION.add(model_id)
+                response = _gemini_generate(model_id, None, _inline_system(system, contents), session)
+
+        if not response.candidates:
+            if hasattr(response, "prompt_feedback") and response.prompt_feedback.block_reason:
+                block_reason = response.prompt_feedback.block_reason.name
+                return {"text": None, "blocked": f"❌ CONTENUTO BLOCCATO DA GEMINI. Motivo: {block_reason}"}
+            else:
+                return {"text": None, "blocked": "❌ ERRORE GEMINI SCONOSCIUTO: Nessun candidato restituito."}
+        return {"text": response.text, "blocked": None}
+
+    # ---------- CLAUDE (ANTHROPIC) ----------
+    elif provider == "Claude (Anthropic)":
+        client = Anthropic(api_key=api_key)
+        # Claude gestisce system prompt separatamente
+        system_msg = messages[0]['content']
+        user_msgs = messages[1:]
+        if session is not None and len(user_msgs) > 1:
+            # Breakpoint di cache sull'ultima risposta: è il prefisso che il turno
+            # successivo ripete identico (l'ultimo messaggio contiene l'istruzione del turno)
+            idx = len(user_msgs) - 2
+            prev = user_msgs[idx]
+            user_msgs = user_msgs[:idx] + [{"role": prev["role"], "content": [
+                {"type": "text", "text": prev["content"], "cache_control": {"type": "ephemeral"}}
+            ]}] + user_msgs[idx + 1:]
+
+        response = client.messages.create(
+            model=model_id,
+            max_tokens=4096,
+            system=system_msg,
+            messages=user_msgs
+        )
+        return {"text": response.content[0].text, "blocked": None}
+
+    raise ValueError(f"Provider non supportato: {provider}")
+
+
+def call_ai(provider, model_id, api_key, prompt, history=None, json_mode=False, session=None):
+    """
+    Wrapper unico per tutti i provider.
+    Restituisce testo (string) o JSON (list/dict) a seconda di `json_mode`.
+    Con una `ChatSession` il prefisso della conversazione viene riusato lato provider.
+    """
+    if json_mode:
+        json_instruction = """
+        RISPONDI ESCLUSIVAMENTE CON UN ARRAY JSON VALIDO con esattamente 2 oggetti.
+        IL TUO OUTPUT DEVE ESSERE RACCHIUSO ESATTAMENTE TRA I DELIMITATORI: ###OUTPUT_JSON_START### e ###OUTPUT_JSON_END###.
+        Non includere testo introduttivo, commenti, o delimitatori di codice (```json) all'esterno.
+        """
+        prompt += "\n" + json_instruction
+
+    # L'istruzione del turno si aggancia solo all'ultimo messaggio utente
+    turns = _merge_turns([{"role": role, "content": content} for role, content in history or []]
+                         + [{"role": "user", "content": prompt}])
+    messages = [{"role": "system", "content": SYSTEM_PROMPT}] + turns
+
+    try:
+        result = _complete(provider, model_id, api_key, messages, session=session)
+        if result["blocked"]:
+            return result["blocked"]
+        text_response = result["text"]
+
+        # ---------- RETURN -------------------------------------------------
+        if json_mode:
+            try:
+                cleaned_text = clean_json_text(text_response)
+                return json.loads(cleaned_text)
+            except json.JSONDecodeError:
+                return [{"titolo": "Errore Formato",
+                         "descrizione": f"L'AI non ha risposto in JSON valido.\nRaw: {text_response}"}]
+        else:
+            return text_response
+
+    except Exception as e:
+        if json_mode:
+            return [{"titolo": "Errore API", "descrizione": f"Errore tecnico: {str(e)}"}]
+        else:
+            return f"❌ Errore API: {str(e)}"
+
+
+def is_error_response(response):
+    """True se `call_ai` ha restituito uno dei suoi messaggi di errore."""
+    if response is None:
+        return True
+    if isinstance(response, str):
+        return response.startswith("❌")
+    if isinstance(response, list) and len(response) == 1 and isinstance(response[0], dict):
+        return response[0].get("titolo") in ("Errore API", "Errore Formato")
+    return False
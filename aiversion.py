@@ -2,7 +2,9 @@ import google.generativeai as genai
 from openai import OpenAI
 from anthropic import Anthropic
 import os
+import cassette
 
+@cassette.recordable("aiversion.get_gemini_models")
 def get_gemini_models(api_key):
     """Interroga Google per ottenere i modelli disponibili per questa API Key."""
     if not api_key: return ["Inserisci API Key prima"]
@@ -16,6 +18,7 @@ def get_gemini_models(api_key):
     except Exception as e:
         return [f"Errore: {str(e)}"]
 
+@cassette.recordable("aiversion.get_openai_models")
 def get_openai_models(api_key, base_url=None):
     """Recupera modelli da OpenAI o compatibili (Groq, Grok)."""
     if not api_key: return ["Inserisci API Key prima"]
@@ -52,3 +55,29 @@ def get_anthropic_models(api_key):
         "claude-3-haiku-20240307"
     ]
     return known_models
+
+def get_groq_models(api_key):
+    """Lista curata dei modelli Groq (l'endpoint /models include anche whisper & co.)."""
+    if not api_key: return ["Inserisci API Key prima"]
+    return [
+        "llama-3.3-70b-versatile",
+        "llama-3.1-70b-versatile",
+        "llama-3.1-8b-instant",
+        "llama3-70b-8192",
+        "llama3-8b-8192",
+        "gemma2-9b-it"
+    ]
+
+def get_models(provider, api_key):
+    """Dispatcher unico: lista modelli per il provider indicato."""
+    if provider == "Google Gemini":
+        return get_gemini_models(api_key)
+    elif provider == "ChatGPT":
+        return get_openai_models(api_key)
+    elif provider == "Claude (Anthropic)":
+        return get_anthropic_models(api_key)
+    elif provider == "Groq":
+        return get_groq_models(api_key)
+    elif provider == "Grok (xAI)":
+        return get_openai_models(api_key, base_url="https://api.x.ai/v1")
+    return []
@@ -1,12 +1,12 @@
 import streamlit as st
-import google.generativeai as genai
-from openai import OpenAI
-from anthropic import Anthropic
 import aiversion
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import cassette
+import prompts
+import sheetsdb
+from aicall import call_ai, ChatSession, API_KEY_NAMES, PROVIDERS
+from router import ModelRouter, TASKS, TIER_NAMES
 from datetime import datetime
-import json
+import logging
 import re
 import requests
 
@@ -18,23 +18,19 @@ def sanitize_filename(title):
     return re.sub(r'[^\w\-_]', '', title.replace(' ', '_'))
 
 
+# Record/replay opzionale delle chiamate esterne (vedi cassette.py)
+cassette.install_from_env()
+
+
 # ----------------------------------------------------------------------
 # 1️⃣ GESTIONE DATABASE (GOOGLE SHEETS)
 # ----------------------------------------------------------------------
-SHEET_NAME = "TimmyWonka_DB"
-CATALOG_SHEET_TITLE = "CatalogoCompleto"
-
 def get_db_connection(worksheet_index=0):
     try:
-        scope = ["https://spreadsheets.google.com/feeds",
-                 "https://www.googleapis.com/auth/drive"]
+        if cassette.replaying():
+            return sheetsdb.open_worksheet(None, worksheet_index)
         if "gcp_service_account" in st.secrets:
-            creds_dict = dict(st.secrets["gcp_service_account"])
-            if "\\n" in creds_dict["private_key"]:
-                creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-            client = gspread.authorize(creds)
-            return client.open(SHEET_NAME).get_worksheet(worksheet_index)
+            return sheetsdb.open_worksheet(st.secrets["gcp_service_account"], worksheet_index)
         return None
     except Exception as e:
         print(f"DB Connection Error: {e}")
@@ -55,10 +51,7 @@ def load_catalog_titles():
     try:
         sheet = get_db_connection(worksheet_index=1)      # indice 1 = CatalogoCompleto
         if sheet:
-            titles = sheet.col_values(1)[1:] if sheet.col_values(1) else []
-            themes = sheet.col_values(2)[1:] if sheet.col_values(2) else []
-            catalog_list = [f"Titolo: {t}, Tema: {th}" for t, th in zip(titles, themes) if t and th]
-            return catalog_list
+            return sheetsdb.catalog_titles(sheet)
         return []
     except Exception as e:
         print(f"Errore caricamento Catalogo: {e}")
@@ -78,7 +71,7 @@ def save_to_gsheet(title, description, vibe, author, full_concept):
                 return False
 
             if not titles:
-                sheet.append_row(["Titolo", "Tema", "Vibe", "Data", "Autore", "Concept"])
+                sheet.append_row(sheetsdb.IDEAS_HEADER)
 
             date_str = datetime.now().strftime("%Y-%m-%d %H:%M")
             row = [title, description, vibe, date_str]
@@ -145,6 +138,22 @@ if not st.session_state.authenticated:
 # ----------------------------------------------------------------------
 # 4️⃣ LOGICA AI (solo la porzione di configurazione AI)
 # ----------------------------------------------------------------------
+@st.cache_resource
+def get_router():
+    """Router condiviso tra le sessioni: le statistiche di latenza/errori sono globali."""
+    # Le decisioni di routing finiscono nel log del server Streamlit
+    router_logger = logging.getLogger("timmywonka.router")
+    if not router_logger.handlers:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(name)s %(message)s"))
+        router_logger.addHandler(handler)
+        router_logger.setLevel(logging.INFO)
+    return ModelRouter()
+
+@st.cache_data(ttl=3600)
+def load_models(provider, api_key):
+    return aiversion.get_models(provider, api_key)
+
 with st.expander("🧠 Configurazione Cervello AI", expanded=True):
     c1, c2, c3 = st.columns([1, 1, 2])
 
@@ -152,7 +161,7 @@ with st.expander("🧠 Configurazione Cervello AI", expanded=True):
     with c1:
         provider = st.selectbox(
             "Provider",
-            ["Google Gemini", "ChatGPT", "Claude (Anthropic)", "Groq", "Grok (xAI)"],
+            PROVIDERS,
             key="unique_provider_selector"
         )
         st.session_state.provider = provider
@@ -160,18 +169,14 @@ with st.expander("🧠 Configurazione Cervello AI", expanded=True):
     # ---------- API‑KEY (da secrets) ----------
     with c2:
         # Mappa Provider → nome della chiave nel file secrets.toml
-        key_map = {
-            "Google Gemini": "GOOGLE_API_KEY",
-            "ChatGPT": "OPENAI_API_KEY",
-            "Claude (Anthropic)": "ANTHROPIC_API_KEY",
-            "Groq": "GROQ_API_KEY",
-            "Grok (xAI)": "XAI_API_KEY",
-        }
-        secret_key_name = key_map[provider]
+        secret_key_name = API_KEY_NAMES[provider]
 
         # **Qui leggiamo solo da st.secrets**
         if secret_key_name in st.secrets:
             api_key = st.secrets[secret_key_name]
+        elif cassette.replaying():
+            # In replay le risposte arrivano dalla cassetta: basta un segnaposto
+            api_key = "replay"
         else:
             # Se manca la chiave blocchiamo l’app con un messaggio esplicito
             st.error(
@@ -187,31 +192,7 @@ with st.expander("🧠 Configurazione Cervello AI", expanded=True):
         models = []
         if api_key:
             try:
-                if provider == "Google Gemini":
-                    models = aiversion.get_gemini_models(api_key)
-
-                elif provider == "ChatGPT":
-                    models = aiversion.get_openai_models(api_key)
-
-                elif provider == "Claude (Anthropic)":
-                    models = aiversion.get_anthropic_models(api_key)
-
-                elif provider == "Groq":
-                    # --- LISTA MODELLI GROQ AGGIORNATA ---
-                    models = [
-                        "llama-3.3-70b-versatile",
-                        "llama-3.1-70b-versatile",
-                        "llama-3.1-8b-instant",
-                        "llama3-70b-8192",
-                        "llama3-8b-8192",
-                        "gemma2-9b-it"
-                    ]
-
-                elif provider == "Grok (xAI)":
-                    models = aiversion.get_openai_models(
-                        api_key,
-                        base_url="https://api.x.ai/v1"
-                    )
+                models = aiversion.get_models(provider, api_key)
             except Exception as exc:
                 st.warning(f"⚠️ Impossibile recuperare i modelli: {exc}")
                 models = []
@@ -236,116 +217,65 @@ with st.expander("🧠 Configurazione Cervello AI", expanded=True):
             )
         st.session_state.selected_model = selected_model
 
-# ----------------------------------------------------------------------
-# FUNZIONE GENERICA DI CHIAMATA AI
-# ----------------------------------------------------------------------
-SYSTEM_PROMPT = "Sei un esperto creativo di team building."
-
-def clean_json_text(text):
-    """Pulisce la stringa JSON da markdown extra."""
-    text = text.strip()
-    if "###OUTPUT_JSON_START###" in text:
-        text = text.split("###OUTPUT_JSON_START###")[1]
-    if "###OUTPUT_JSON_END###" in text:
-        text = text.split("###OUTPUT_JSON_END###")[0]
-    # Rimuovi ```json e ```
-    text = re.sub(r'^```json\s*', '', text)
-    text = re.sub(r'^```\s*', '', text)
-    text = re.sub(r'\s*```$', '', text)
-    return text.strip()
-
-def call_ai(provider, model_id, api_key, prompt, history=None, json_mode=False):
-    """
-    Wrapper unico per tutti i provider.
-    Restituisce testo (string) o JSON (list/dict) a seconda di `json_mode`.
-    """
-    messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-    if history:
-        for role, content in history:
-            messages.append({"role": role, "content": content})
-    messages.append({"role": "user", "content": prompt})
-
-    if json_mode:
-        json_instruction = """
-        RISPONDI ESCLUSIVAMENTE CON UN ARRAY JSON VALIDO con esattamente 2 oggetti. 
-        IL TUO OUTPUT DEVE ESSERE RACCHIUSO ESATTAMENTE TRA I DELIMITATORI: ###OUTPUT_JSON_START### e ###OUTPUT_JSON_END###.
-        Non includere testo introduttivo, commenti, o delimitatori di codice (```json) all'esterno.
-        """
-        messages[-1]["content"] += "\n" + json_instruction
-
-    try:
-        # ---------- OPENAI‑compatible (ChatGPT, Groq, Grok) ----------
-        if provider in ["ChatGPT", "Groq", "Grok (xAI)"]:
-            base_url = None
-            if provider == "Groq":
-                base_url = "https://api.groq.com/openai/v1"
-            elif provider == "Grok (xAI)":
-                base_url = "https://api.x.ai/v1"
-
-            client = OpenAI(api_key=api_key, base_url=base_url)
-            response = client.chat.completions.create(
-                model=model_id,
-                messages=messages
-            )
-            text_response = response.choices[0].message.content
-
-        # ---------- GOOGLE GEMINI ----------
-        elif provider == "Google Gemini":
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel(model_id)
-            # Gemini non usa la struttura messages, quindi trasformiamo:
-            final_prompt = "\n".join([f"[{m['role'].upper()}]: {m['content']}" for m in messages[1:]])
-            response = model.generate_content(final_prompt)
-
-            if not response.candidates:
-                if hasattr(response, "prompt_feedback") and response.prompt_feedback.block_reason:
-                    block_reason = response.prompt_feedback.block_reason.name
-                    return f"❌ CONTENUTO BLOCCATO DA GEMINI. Motivo: {block_reason}"
-                else:
-                    return "❌ ERRORE GEMINI SCONOSCIUTO: Nessun candidato restituito."
-            text_response = response.text
-
-        # ---------- CLAUDE (ANTHROPIC) ----------
-        elif provider == "Claude (Anthropic)":
-            client = Anthropic(api_key=api_key)
-            # Claude gestisce system prompt separatamente
-            system_msg = messages[0]['content']
-            user_msgs = messages[1:]
-            
-            response = client.messages.create(
-                model=model_id,
-                max_tokens=4096,
-                system=system_msg,
-                messages=user_msgs
-            )
-            text_response = response.content[0].text
-
-        # ---------- RETURN -------------------------------------------------
-        if json_mode:
-            try:
-                cleaned_text = clean_json_text(text_response)
-                return json.loads(cleaned_text)
-            except json.JSONDecodeError:
-                return [{"titolo": "Errore Formato",
-                         "descrizione": f"L'AI non ha risposto in JSON valido.\nRaw: {text_response}"}]
-        else:
-            return text_response
-
-    except Exception as e:
-        if json_mode:
-            return [{"titolo": "Errore API", "descrizione": f"Errore tecnico: {str(e)}"}]
-        else:
-            return f"❌ Errore API: {str(e)}"
-
+    # ---------- ROUTING AUTOMATICO ----------
+    auto_routing = st.checkbox(
+        "⚡ Routing automatico: per ogni task usa il modello sano più veloce (la selezione sopra resta come fallback)",
+        key="auto_routing"
+    )
+    if auto_routing:
+        router = get_router()
+        for p in PROVIDERS:
+            if API_KEY_NAMES[p] in st.secrets:
+                p_key = st.secrets[API_KEY_NAMES[p]]
+                router.set_candidates(p, p_key, load_models(p, p_key))
+            elif cassette.replaying():
+                router.set_candidates(p, "replay", load_models(p, "replay"))
+
+        st.select_slider("Qualità minima", options=list(TIER_NAMES),
+                         format_func=TIER_NAMES.get, key="routing_min_tier")
+
+        st.caption("Pin per task (opzionale):")
+        pin_options = ["Auto"] + [f"{p} / {m}" for p, m in router.candidates]
+        routing_pins = {}
+        for col, (task, label) in zip(st.columns(len(TASKS)), TASKS.items()):
+            choice = col.selectbox(label, pin_options, key=f"routing_pin_{task}")
+            if choice != "Auto":
+                routing_pins[task] = tuple(choice.split(" / ", 1))
+        st.session_state.routing_pins = routing_pins
+
+        if router.decisions:
+            last = router.decisions[-1]
+            st.caption(f"Ultima scelta: {TASKS.get(last['task'], last['task'])} → "
+                       f"{last['provider']} / {last['model']} ({last['reason']})")
+            st.dataframe(router.snapshot(), use_container_width=True)
+            with st.expander("📜 Log decisioni di routing", expanded=False):
+                st.dataframe([
+                    {"Ora": datetime.fromtimestamp(d["time"]).strftime("%H:%M:%S"),
+                     "Task": TASKS.get(d["task"], d["task"]),
+                     "Provider": d["provider"], "Modello": d["model"], "Motivo": d["reason"]}
+                    for d in reversed(router.decisions)
+                ], use_container_width=True)
 
 # ----------------------------------------------------------------------
 # FUNZIONE DI COMFORT: verifica che sia stato scelto un modello
 # ----------------------------------------------------------------------
-def safe_call_ai(provider, model_id, api_key, prompt, history=None, json_mode=False):
+def safe_call_ai(provider, model_id, api_key, prompt, history=None, json_mode=False, task=None,
+                 session=None):
+    if task and st.session_state.get("auto_routing"):
+        fallback = (provider, model_id, api_key) if model_id else None
+        try:
+            return get_router().call(task, prompt, history=history, json_mode=json_mode,
+                                     fallback=fallback,
+                                     min_tier=st.session_state.get("routing_min_tier"),
+                                     pins=st.session_state.get("routing_pins", {}),
+                                     session=session)
+        except RuntimeError as e:
+            st.error(f"❌ Routing automatico: {e}")
+            return None
     if not model_id:
         st.error("❌ Nessun modello selezionato. Controlla la sezione ‘Configurazione Cervello AI’.")
         return None
-    return call_ai(provider, model_id, api_key, prompt, history, json_mode)
+    return call_ai(provider, model_id, api_key, prompt, history, json_mode, session=session)
 
 
 # ----------------------------------------------------------------------
@@ -368,27 +298,21 @@ def generate_technical_sheet(concept_title, activity_input, vibes_input,
     capex = st.session_state.get('capex', 0)
     opex = st.session_state.get('opex', 0)
     rrp = st.session_state.get('rrp', 0)
-    budget_info = f"Budget Previsto: Costi Fissi {capex}€, Costi Variabili {opex}€/pax, Prezzo Vendita {rrp}€/pax."
-
-    initial_prompt = f"""
-    Genera la Scheda Tecnica dettagliata per il format: "{concept_title}".
-    Tema Originale: {activity_input}. Vibe: {vibes_input}.
-    {budget_info}
-     
-    Output richiesto: Scheda Tecnica completa, formattata in Markdown.
-    IMPORTANTE: La descrizione deve focalizzarsi sulle dinamiche, l'esperienza utente e la logistica.
-    Se i dati di budget sono > 0, includi una breve analisi di fattibilità economica.
-    NO Acronimi.
-    """
-    
-    # <<< MODIFICA: Ho rimosso il divieto "NON includere analisi di costi..." >>>
 
+    # Prompt condiviso con la pipeline batch (vedi prompts.py)
+    initial_prompt = prompts.build_technical_sheet_prompt(
+        concept_title, activity_input, vibes_input, capex, opex, rrp
+    )
+
+    # Nuova conversazione di Fase 2: la sessione (e la sua cache) vale fino al prossimo concept
+    if st.session_state.get("phase2_session"):
+        st.session_state.phase2_session.close()
+    st.session_state.phase2_session = ChatSession()
     st.session_state.assets = safe_call_ai(provider, selected_model, api_key,
-                                           initial_prompt, json_mode=False)
-    st.session_state.phase2_history = [
-        ("user", "Inizio Fase 2: Richiesta Scheda Tecnica Dettagliata."),
-        ("assistant", st.session_state.assets)
-    ]
+                                           initial_prompt, json_mode=False,
+                                           task="technical_sheet",
+                                           session=st.session_state.phase2_session)
+    st.session_state.phase2_history = prompts.initial_phase2_history(st.session_state.assets)
 
 
 def handle_refinement_turn(comment):
@@ -396,24 +320,7 @@ def handle_refinement_turn(comment):
     st.session_state.phase2_history.append(("user", comment))
 
     history_messages = st.session_state.phase2_history
-    is_final_summary_request = any(
-        kw in comment.lower() for kw in ["riassunto", "finale", "salvare"]
-    )
-
-    if is_final_summary_request:
-        last_prompt = """
-        L'utente sta chiedendo un riassunto finale o un documento da salvare. 
-        Basandoti sulla Scheda Tecnica attuale (che è il contenuto della penultima risposta dell'assistente nella history), genera un documento di riepilogo pulito e finale in Markdown. 
-        L'output deve essere SOLO il documento di riepilogo/conclusione.
-        """
-    else:
-        # <<< MODIFICA: Ho rimosso il divieto sui costi >>>
-        last_prompt = """
-        Rispondi alla richiesta dell'utente. Se l'utente chiede una modifica alla Scheda Tecnica, ricreala interamente con le revisioni richieste. 
-        Se l'utente chiede un nuovo materiale (es. lista di controllo, pitch) o una stima dei costi, produci quel materiale.
-        L'output deve essere SOLO il contenuto richiesto in Markdown.
-        Se richiesto, fornisci stime economiche basate sui dati forniti o su standard di mercato ragionevoli.
-        """
+    last_prompt = prompts.build_refinement_prompt(comment)
 
     new_response = safe_call_ai(
         st.session_state.provider,
@@ -422,6 +329,8 @@ def handle_refinement_turn(comment):
         last_prompt,
         history=history_messages,
         json_mode=False,
+        task="refinement",
+        session=st.session_state.get("phase2_session"),
     )
     st.session_state.phase2_history.append(("assistant", new_response))
     st.session_state.assets = new_response
@@ -512,22 +421,12 @@ st.session_state.activity_input = activity_input
 if st.button("✨ Inventa 2 Idee", type="primary"):
     with st.spinner("Brainstorming..."):
         catalog_list = load_catalog_titles()
-        catalog_prompt = "\n".join(catalog_list)
-
-        budget_str = "Libero" if (capex + opex + rrp) == 0 else f"Fissi {capex}€, Var {opex}€, Vendita {rrp}€"
-
-        prompt = f"""
-        Genera 2 concept distinti per: {activity_input}. 
-        Vibe: {vibes_input}. Budget: {budget_str}. 
-        Logistica: {tech_level}, {phys_level}, {', '.join(locs)}.
-         
-        IMPORTANTE: NON generare idee che siano SIMILI a quelle presenti nel Catalogo Completo sottostante.
-        Catalogo Completo (Titolo e Tema):
-        ---
-        {catalog_prompt}
-        ---
-        """
-        response = safe_call_ai(provider, selected_model, api_key, prompt, json_mode=True)
+        prompt = prompts.build_concepts_prompt(
+            activity_input, vibes_input, capex, opex, rrp,
+            tech_level, phys_level, locs, catalog_list
+        )
+        response = safe_call_ai(provider, selected_model, api_key, prompt, json_mode=True,
+                                task="concept_json")
         if isinstance(response, list):
             st.session_state.concepts_list = response
         else:
@@ -572,13 +471,9 @@ if st.session_state.concepts_list:
 
             if c3.button("🔄 Rigenera (Boccia)", key=f"regen_{idx}"):
                 with st.spinner(f"Rimpiazzo l'idea {idx + 1}..."):
-                    p_regen = f"""
-                    L'utente ha scartato l'idea "{concept_title}". 
-                    Genera 1 NUOVO concept alternativo per il tema {activity_input}.
-                    Stessi vincoli.
-                    """
+                    p_regen = prompts.build_regen_prompt(concept_title, activity_input)
                     new_concept = safe_call_ai(provider, selected_model, api_key,
-                                              p_regen, json_mode=True)
+                                              p_regen, json_mode=True, task="card_regen")
                     if isinstance(new_concept, list) and len(new_concept) > 0:
                         st.session_state.concepts_list[idx] = new_concept[0]
                         st.rerun()
@@ -656,7 +551,7 @@ if st.session_state.assets:
     st.header("Fase 3: Sales Pitch 💼")
     if st.button("Genera Slide"):
         with st.spinner("Writing pitch..."):
-            p_pitch = f"Sales pitch per '{st.session_state.selected_concept}'. Target HR. Prezzo {rrp}."
+            p_pitch = prompts.build_pitch_prompt(st.session_state.selected_concept, rrp)
             pitch_res = safe_call_ai(
                 st.session_state.provider,
                 st.session_state.selected_model,
@@ -664,6 +559,7 @@ if st.session_state.assets:
                 p_pitch,
                 history=st.session_state.phase2_history,
                 json_mode=False,
+                task="pitch",
             )
             st.markdown(pitch_res)
             file_name_pitch = f"{sanitize_filename(st.session_state.selected_concept)}_Pitch.txt"
@@ -0,0 +1,334 @@
+"""
+Pipeline headless Timmy Wonka: Fase 1 → Scheda Tecnica → Pitch, senza Streamlit.
+
+Legge un CSV o JSONL di temi (colonne: id, tema, vibe, capex, opex, rrp e, opzionali,
+tech, fisicita, location, provider, model), esegue la pipeline completa in parallelo
+con un limite di chiamate contemporanee per provider e scrive un record JSONL per tema.
+Le righe già presenti con status "ok" (e stesso input) nel file di output vengono
+saltate (resume); senza colonna id l'id è un hash del contenuto della riga.
+
+Esempio:
+    python batch.py temi.csv -o risultati.jsonl --provider Groq \\
+        --model llama-3.3-70b-versatile --max-per-provider 3 --save-db
+"""
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import tomllib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import aiversion
+import cassette
+import prompts
+import sheetsdb
+from aicall import call_ai, is_error_response, ChatSession, API_KEY_NAMES, PROVIDERS
+from router import ModelRouter, TIER_NAMES
+
+SECRETS_PATH = os.path.join(".streamlit", "secrets.toml")
+
+
+# ----------------------------------------------------------------------
+# CONFIGURAZIONE (variabili d'ambiente o .streamlit/secrets.toml)
+# ----------------------------------------------------------------------
+def load_secrets(path=SECRETS_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
+def get_api_key(provider, secrets):
+    key_name = API_KEY_NAMES[provider]
+    return os.environ.get(key_name) or secrets.get(key_name)
+
+
+def load_service_account(path, secrets):
+    if path:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    return secrets.get("gcp_service_account")
+
+
+# ----------------------------------------------------------------------
+# INPUT / OUTPUT
+# ----------------------------------------------------------------------
+def _row_id(row):
+    """Id derivato dal contenuto: resta stabile se il file viene riordinato o esteso."""
+    canonical = json.dumps(row, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(canonical.encode("utf-8")).hexdigest()[:12]
+
+
+def read_themes(path):
+    """Legge i temi da CSV o JSONL; ogni riga riceve un `id` stabile per il resume."""
+    if path.endswith(".jsonl"):
+        with open(path, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+    else:
+        with open(path, encoding="utf-8", newline="") as f:
+            rows = list(csv.DictReader(f))
+    for row in rows:
+        if not row.get("id"):
+            row.pop("id", None)
+            row["id"] = _row_id(row)
+        row["id"] = str(row["id"])
+    return rows
+
+
+def is_done(row, done):
+    """Tema già completato con lo stesso input (se la riga è stata modificata si rigenera)."""
+    record = done.get(row["id"])
+    return bool(record) and record.get("status") == "ok" and record.get("input") == row
+
+
+def read_checkpoint(path):
+    """Record già scritti nell'output; l'ultimo record per id vince."""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Riga troncata da un'interruzione: verrà rigenerata
+                continue
+            done[record["id"]] = record
+    return done
+
+
+def _number(row, key):
+    try:
+        value = float(row.get(key) or 0)
+    except ValueError:
+        return 0
+    return int(value) if value.is_integer() else value
+
+
+def _locations(row):
+    locs = row.get("location") or "Indoor"
+    if isinstance(locs, list):
+        return locs
+    return [l.strip() for l in locs.split(",") if l.strip()]
+
+
+# ----------------------------------------------------------------------
+# PIPELINE
+# ----------------------------------------------------------------------
+class ProviderLimiter:
+    """Limita le chiamate AI contemporanee per singolo provider."""
+
+    def __init__(self, max_per_provider):
+        self._semaphores = defaultdict(lambda: threading.BoundedSemaphore(max_per_provider))
+        self._lock = threading.Lock()
+
+    def slot(self, provider):
+        with self._lock:
+            return self._semaphores[provider]
+
+    def call(self, provider, *args, **kwargs):
+        with self.slot(provider):
+            return call_ai(provider, *args, **kwargs)
+
+
+def run_theme(row, defaults, api_keys, catalog_list, limiter, router=None, min_tier=None):
+    """
+    Esegue la pipeline completa per un tema e restituisce il record JSONL.
+    Con `router` ogni task viene instradato automaticamente; provider/model della riga
+    restano come fallback.
+    """
+    provider = row.get("provider") or defaults["provider"]
+    model_id = row.get("model") or defaults["model"]
+    api_key = api_keys.get(provider)
+    activity_input = row.get("tema", "")
+    vibes_input = row.get("vibe", "")
+    capex, opex, rrp = _number(row, "capex"), _number(row, "opex"), _number(row, "rrp")
+    started = time.monotonic()
+
+    record = {"id": row["id"], "input": row, "provider": provider, "model": model_id,
+              "status": "ok", "concepts": []}
+    if router:
+        record["provider"] = record["model"] = "auto"
+    elif not api_key:
+        record["status"] = "error"
+        record["error"] = f"Manca la chiave {API_KEY_NAMES.get(provider, provider)}"
+        return record
+
+    def ask(task, prompt, history=None, json_mode=False, session=None):
+        if router:
+            fallback = (provider, model_id, api_key) if api_key else None
+            return router.call(task, prompt, history=history, json_mode=json_mode,
+                               fallback=fallback, min_tier=min_tier, session=session,
+                               limit=limiter.slot)
+        return limiter.call(provider, model_id, api_key, prompt,
+                            history=history, json_mode=json_mode, session=session)
+
+    concepts_prompt = prompts.build_concepts_prompt(
+        activity_input, vibes_input, capex, opex, rrp,
+        row.get("tech") or "Hybrid", row.get("fisicita") or "Leggero",
+        _locations(row), catalog_list
+    )
+    concepts = ask("concept_json", concepts_prompt, json_mode=True)
+    if is_error_response(concepts) or not isinstance(concepts, list):
+        record["status"] = "error"
+        record["error"] = concepts
+        return record
+
+    for concept in concepts:
+        title = concept.get('titolo', concept.get('title', 'Senza Titolo'))
+        description = concept.get('descrizione', concept.get('description', ""))
+
+        sheet_prompt = prompts.build_technical_sheet_prompt(
+            title, activity_input, vibes_input, capex, opex, rrp
+        )
+        # Scheda e pitch sono una conversazione: il pitch riusa il prefisso in cache
+        session = ChatSession()
+        assets = ask("technical_sheet", sheet_prompt, json_mode=False, session=session)
+        pitch = None
+        if not is_error_response(assets):
+            pitch = ask("pitch", prompts.build_pitch_prompt(title, rrp),
+                        history=prompts.initial_phase2_history(assets),
+                        json_mode=False, session=session)
+        session.close()
+        if is_error_response(assets) or is_error_response(pitch):
+            record["status"] = "error"
+
+        record["concepts"].append({"titolo": title, "descrizione": description,
+                                   "scheda_tecnica": assets, "pitch": pitch})
+
+    record["elapsed_s"] = round(time.monotonic() - started, 2)
+    return record
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pipeline batch Timmy Wonka (headless).")
+    parser.add_argument("input", help="CSV o JSONL con i temi")
+    parser.add_argument("-o", "--output", default="batch_results.jsonl")
+    parser.add_argument("--provider", choices=PROVIDERS, default="Groq")
+    parser.add_argument("--model", default="llama-3.3-70b-versatile")
+    parser.add_argument("--workers", type=int, default=8, help="temi elaborati in parallelo")
+    parser.add_argument("--max-per-provider", type=int, default=3,
+                        help="chiamate AI contemporanee per provider")
+    parser.add_argument("--credentials", help="JSON del service account Google (default: secrets.toml)")
+    parser.add_argument("--no-catalog", action="store_true",
+                        help="non caricare il Catalogo Completo per il controllo duplicati")
+    parser.add_argument("--save-db", action="store_true",
+                        help="a fine run salva in blocco nel DB i concept completati")
+    parser.add_argument("--auto", action="store_true",
+                        help="routing automatico per task tra tutti i provider con chiave")
+    parser.add_argument("--min-tier", type=int, choices=list(TIER_NAMES),
+                        help="qualità minima per il routing automatico (1=Veloce, 3=Premium)")
+    parser.add_argument("--record", metavar="CASSETTA",
+                        help="registra richieste/risposte/tempi in una cassetta (.jsonl.gz)")
+    parser.add_argument("--replay", metavar="CASSETTA",
+                        help="riproduce offline una cassetta registrata (nessuna chiave necessaria)")
+    parser.add_argument("--replay-timing", choices=cassette.TIMINGS, default="original",
+                        help="in replay: latenze originali o zero")
+    args = parser.parse_args(argv)
+    if args.record:
+        cassette.install(args.record, "record")
+    elif args.replay:
+        cassette.install(args.replay, "replay", args.replay_timing)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(message)s")
+
+    secrets = load_secrets()
+    rows = read_themes(args.input)
+    done = read_checkpoint(args.output)
+    pending = [r for r in rows if not is_done(r, done)]
+    print(f"Temi: {len(rows)} | già completati: {len(rows) - len(pending)} | da elaborare: {len(pending)}")
+
+    providers = {r.get("provider") or args.provider for r in pending}
+    if args.auto:
+        providers = set(PROVIDERS)
+    api_keys = {p: get_api_key(p, secrets) for p in providers if p in API_KEY_NAMES}
+    if cassette.replaying():
+        # In replay le chiavi non escono mai dal processo: basta un segnaposto
+        api_keys = {p: key or "replay" for p, key in api_keys.items()}
+
+    router = None
+    if args.auto:
+        router = ModelRouter()
+        for p, key in api_keys.items():
+            if key:
+                router.set_candidates(p, key, aiversion.get_models(p, key))
+
+    creds_dict = None
+    if args.save_db or not args.no_catalog:
+        try:
+            creds_dict = load_service_account(args.credentials, secrets)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"⚠️ Service account non leggibile: {e}")
+            return 1
+
+    # Il DB di destinazione si verifica prima del run, non dopo aver pagato tutte le chiamate
+    ideas_sheet = None
+    if args.save_db:
+        if not creds_dict and not cassette.replaying():
+            print("⚠️ --save-db richiede un service account (--credentials o secrets.toml).")
+            return 1
+        try:
+            ideas_sheet = sheetsdb.open_worksheet(creds_dict, 0)
+        except Exception as e:
+            print(f"⚠️ DB non raggiungibile: {e}")
+            return 1
+        if ideas_sheet is None:
+            print(f"⚠️ Foglio idee non trovato in {sheetsdb.SHEET_NAME}.")
+            return 1
+
+    catalog_list = []
+    if (creds_dict or cassette.replaying()) and not args.no_catalog:
+        try:
+            catalog_list = sheetsdb.catalog_titles(sheetsdb.open_worksheet(creds_dict, 1))
+        except Exception as e:
+            print(f"Errore caricamento Catalogo: {e}")
+
+    defaults = {"provider": args.provider, "model": args.model}
+    limiter = ProviderLimiter(args.max_per_provider)
+    write_lock = threading.Lock()
+
+    with open(args.output, "a", encoding="utf-8") as out, \
+            ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = {pool.submit(run_theme, row, defaults, api_keys, catalog_list, limiter,
+                               router, args.min_tier): row
+                   for row in pending}
+        for future in as_completed(futures):
+            row = futures[future]
+            try:
+                record = future.result()
+            except Exception as e:
+                record = {"id": row["id"], "input": row, "status": "error", "error": str(e)}
+            with write_lock:
+                out.write(json.dumps(record, ensure_ascii=False) + "\n")
+                out.flush()
+            done[record["id"]] = record
+            print(f"[{record['status']}] {record['id']}: {row.get('tema', '')}")
+
+    if router:
+        for stats in router.snapshot():
+            print(stats)
+
+    if ideas_sheet is not None:
+        ideas = []
+        for row in rows:
+            if not is_done(row, done):
+                continue
+            record = done[row["id"]]
+            vibe = record["input"].get("vibe", "")
+            ideas.extend((c["titolo"], c["descrizione"], vibe) for c in record["concepts"])
+        try:
+            added = sheetsdb.bulk_save_ideas(ideas_sheet, ideas)
+        except Exception as e:
+            print(f"⚠️ Errore salvataggio DB (i risultati restano in {args.output}): {e}")
+            return 1
+        print(f"💾 Salvate {added} nuove idee nel DB.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,188 @@
+import functools
+import gzip
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+from collections import defaultdict, deque
+
+# ----------------------------------------------------------------------
+# RECORD / REPLAY DELLE CHIAMATE ESTERNE (provider AI, aiversion, Sheets)
+# ----------------------------------------------------------------------
+# Una "cassetta" è un file JSONL compresso gzip: una riga per interazione con
+# richiesta, risposta (o errore) e durata originale. In replay le risposte vengono
+# servite offline, nell'ordine di registrazione per richieste identiche.
+#
+# Attivazione: cassette.install(path, mode, timing) oppure variabili d'ambiente
+#   TIMMY_CASSETTE=sessione.jsonl.gz  TIMMY_CASSETTE_MODE=record|replay
+#   TIMMY_CASSETTE_TIMING=original|zero
+
+MODES = ("record", "replay")
+TIMINGS = ("original", "zero")
+
+
+class CassetteMiss(KeyError):
+    """Richiesta non presente (o già consumata) nella cassetta in modalità replay."""
+
+
+class ReplayedError(Exception):
+    """Errore registrato durante il record e risollevato in replay."""
+
+
+def _canonical(request):
+    return json.dumps(request, sort_keys=True, ensure_ascii=False, default=str)
+
+
+class Cassette:
+    def __init__(self, path, mode="replay", timing="original"):
+        if mode not in MODES:
+            raise ValueError(f"Modalità cassetta non valida: {mode}")
+        if timing not in TIMINGS:
+            raise ValueError(f"Timing cassetta non valido: {timing}")
+        self.path = path
+        self.mode = mode
+        self.timing = timing
+        self._lock = threading.Lock()
+        self._entries = defaultdict(deque)
+        if mode == "replay":
+            self._load()
+        else:
+            # Una nuova registrazione sostituisce la cassetta precedente
+            with gzip.open(self.path, "wt", encoding="utf-8"):
+                pass
+
+    # ---------- FILE ----------
+    def _load(self):
+        with gzip.open(self.path, "rt", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self._entries[entry["k"]].append(entry)
+
+    def _append(self, entry):
+        # Ogni append crea un membro gzip: il file resta leggibile anche dopo un crash
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            f.write(json.dumps(entry, ensure_ascii=False, separators=(",", ":"), default=str) + "\n")
+
+    # ---------- INTERCETTAZIONE ----------
+    def intercept(self, kind, request, func, match=None):
+        """
+        Esegue `func()` registrandone l'esito, oppure lo serve dalla cassetta.
+        La chiave è calcolata su `match` se indicato (altrimenti sull'intera richiesta):
+        serve per le chiamate con argomenti volatili, riprodotte per ordine.
+        """
+        match = request if match is None else match
+        key = hashlib.sha1(f"{kind}:{_canonical(match)}".encode("utf-8")).hexdigest()[:16]
+        if self.mode == "replay":
+            return self._replay(kind, key)
+
+        started = time.monotonic()
+        entry = {"k": key, "kind": kind, "req": request, "res": None, "err": None}
+        try:
+            entry["res"] = func()
+            return entry["res"]
+        except Exception as e:
+            entry["err"], entry["etype"] = str(e), type(e).__name__
+            raise
+        finally:
+            entry["t"] = round(time.monotonic() - started, 3)
+            with self._lock:
+                self._append(entry)
+
+    def _replay(self, kind, key):
+        with self._lock:
+            if key not in self._entries:
+                raise CassetteMiss(f"{kind}: richiesta non registrata nella cassetta {self.path}")
+            queue = self._entries[key]
+            if not queue:
+                # Più chiamate di quelle registrate: il replay non è più fedele
+                raise CassetteMiss(f"{kind}: risposte registrate esaurite nella cassetta {self.path}")
+            entry = queue.popleft()
+        if self.timing == "original":
+            time.sleep(entry["t"])
+        if entry["err"]:
+            raise ReplayedError(entry["err"])
+        return entry["res"]
+
+    def worksheet(self, sheet, worksheet_index):
+        return RecordedWorksheet(self, sheet, worksheet_index)
+
+
+# Scritture gspread: contengono dati volatili (es. data di salvataggio), quindi in
+# replay vengono abbinate per metodo e ordine di chiamata, non per argomenti.
+SHEETS_WRITE_METHODS = {"append_row", "append_rows", "insert_row", "insert_rows",
+                        "update", "update_cell", "batch_update", "delete_rows", "clear"}
+
+
+class RecordedWorksheet:
+    """Proxy di un worksheet gspread: ogni metodo passa dalla cassetta."""
+
+    def __init__(self, cassette, sheet, worksheet_index):
+        self._cassette = cassette
+        self._sheet = sheet
+        self._index = worksheet_index
+
+    def __getattr__(self, name):
+        def method(*args, **kwargs):
+            request = {"worksheet": self._index, "args": list(args), "kwargs": kwargs}
+            match = {"worksheet": self._index} if name in SHEETS_WRITE_METHODS else None
+            return self._cassette.intercept(
+                f"sheets.{name}", request,
+                lambda: getattr(self._sheet, name)(*args, **kwargs),
+                match=match
+            )
+        return method
+
+
+# ----------------------------------------------------------------------
+# CASSETTA ATTIVA (globale al processo)
+# ----------------------------------------------------------------------
+_active = None
+
+def install(path, mode="replay", timing="original"):
+    global _active
+    if _active and (_active.path, _active.mode, _active.timing) == (path, mode, timing):
+        return _active
+    _active = Cassette(path, mode, timing)
+    return _active
+
+def install_from_env():
+    path = os.environ.get("TIMMY_CASSETTE")
+    if not path:
+        return None
+    return install(path,
+                   os.environ.get("TIMMY_CASSETTE_MODE", "replay"),
+                   os.environ.get("TIMMY_CASSETTE_TIMING", "original"))
+
+def uninstall():
+    global _active
+    _active = None
+
+def active():
+    return _active
+
+def replaying():
+    return _active is not None and _active.mode == "replay"
+
+
+def recordable(kind, ignore=()):
+    """
+    Decoratore: registra/riproduce la funzione; `api_key` (e gli argomenti in `ignore`,
+    es. oggetti di stato non serializzabili) non entrano mai nella cassetta.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            request = {k: v for k, v in bound.arguments.items()
+                       if k != "api_key" and k not in ignore}
+            return _active.intercept(kind, request, lambda: func(*args, **kwargs))
+        return wrapper
+    return decorator
@@ -0,0 +1,85 @@
+# ----------------------------------------------------------------------
+# COSTRUZIONE DEI PROMPT (condivisa tra app Streamlit e batch headless)
+# ----------------------------------------------------------------------
+
+def format_budget(capex, opex, rrp):
+    """Stringa budget compatta usata in Fase 1."""
+    return "Libero" if (capex + opex + rrp) == 0 else f"Fissi {capex}€, Var {opex}€, Vendita {rrp}€"
+
+
+def build_concepts_prompt(activity_input, vibes_input, capex, opex, rrp,
+                          tech_level, phys_level, locs, catalog_list):
+    """Prompt di Fase 1: 2 concept distinti, escludendo i format già a catalogo."""
+    budget_str = format_budget(capex, opex, rrp)
+    catalog_prompt = "\n".join(catalog_list)
+    return f"""
+        Genera 2 concept distinti per: {activity_input}.
+        Vibe: {vibes_input}. Budget: {budget_str}.
+        Logistica: {tech_level}, {phys_level}, {', '.join(locs)}.
+
+        IMPORTANTE: NON generare idee che siano SIMILI a quelle presenti nel Catalogo Completo sottostante.
+        Catalogo Completo (Titolo e Tema):
+        ---
+        {catalog_prompt}
+        ---
+        """
+
+
+def build_regen_prompt(concept_title, activity_input):
+    """Prompt per rimpiazzare una card scartata."""
+    return f"""
+                    L'utente ha scartato l'idea "{concept_title}".
+                    Genera 1 NUOVO concept alternativo per il tema {activity_input}.
+                    Stessi vincoli.
+                    """
+
+
+def build_technical_sheet_prompt(concept_title, activity_input, vibes_input, capex, opex, rrp):
+    """Prompt iniziale di Fase 2 (Scheda Tecnica)."""
+    budget_info = f"Budget Previsto: Costi Fissi {capex}€, Costi Variabili {opex}€/pax, Prezzo Vendita {rrp}€/pax."
+    return f"""
+    Genera la Scheda Tecnica dettagliata per il format: "{concept_title}".
+    Tema Originale: {activity_input}. Vibe: {vibes_input}.
+    {budget_info}
+
+    Output richiesto: Scheda Tecnica completa, formattata in Markdown.
+    IMPORTANTE: La descrizione deve focalizzarsi sulle dinamiche, l'esperienza utente e la logistica.
+    Se i dati di budget sono > 0, includi una breve analisi di fattibilità economica.
+    NO Acronimi.
+    """
+
+
+def initial_phase2_history(assets):
+    """History di partenza della chat di refinement dopo la Scheda Tecnica."""
+    return [
+        ("user", "Inizio Fase 2: Richiesta Scheda Tecnica Dettagliata."),
+        ("assistant", assets)
+    ]
+
+
+FINAL_SUMMARY_KEYWORDS = ["riassunto", "finale", "salvare"]
+
+FINAL_SUMMARY_PROMPT = """
+        L'utente sta chiedendo un riassunto finale o un documento da salvare.
+        Basandoti sulla Scheda Tecnica attuale (che è il contenuto della penultima risposta dell'assistente nella history), genera un documento di riepilogo pulito e finale in Markdown.
+        L'output deve essere SOLO il documento di riepilogo/conclusione.
+        """
+
+REFINEMENT_PROMPT = """
+        Rispondi alla richiesta dell'utente. Se l'utente chiede una modifica alla Scheda Tecnica, ricreala interamente con le revisioni richieste.
+        Se l'utente chiede un nuovo materiale (es. lista di controllo, pitch) o una stima dei costi, produci quel materiale.
+        L'output deve essere SOLO il contenuto richiesto in Markdown.
+        Se richiesto, fornisci stime economiche basate sui dati forniti o su standard di mercato ragionevoli.
+        """
+
+
+def build_refinement_prompt(comment):
+    """Sceglie il prompt del turno di refinement in base al commento utente."""
+    if any(kw in comment.lower() for kw in FINAL_SUMMARY_KEYWORDS):
+        return FINAL_SUMMARY_PROMPT
+    return REFINEMENT_PROMPT
+
+
+def build_pitch_prompt(concept_title, rrp):
+    """Prompt di Fase 3 (Sales Pitch)."""
+    return f"Sales pitch per '{concept_title}'. Target HR. Prezzo {rrp}."
@@ -0,0 +1,269 @@
+import contextlib
+import logging
+import re
+import threading
+import time
+from collections import deque
+
+from aicall import call_ai, is_error_response
+
+# ----------------------------------------------------------------------
+# ROUTING AUTOMATICO DEI MODELLI (latenza + salute per provider/modello)
+# ----------------------------------------------------------------------
+logger = logging.getLogger("timmywonka.router")
+
+TASKS = {
+    "concept_json": "Fase 1 - Concept JSON",
+    "card_regen": "Rigenera Card",
+    "technical_sheet": "Scheda Tecnica",
+    "refinement": "Refinement Chat",
+    "pitch": "Sales Pitch",
+}
+
+TIER_NAMES = {1: "Veloce", 2: "Standard", 3: "Premium"}
+
+# Tier minimo di default per task: i brainstorm JSON vanno bene su modelli rapidi,
+# le schede lunghe richiedono almeno un modello "Standard".
+DEFAULT_TASK_TIERS = {
+    "concept_json": 1,
+    "card_regen": 1,
+    "technical_sheet": 2,
+    "refinement": 2,
+    "pitch": 1,
+}
+
+# Il nome del modello viene diviso in token ("gemini-1.5-pro-latest" → gemini, 1.5, pro,
+# latest): così "gemini" non contiene "mini". Gruppi valutati in ordine, il primo vince,
+# quindi le varianti ridotte (mini, nano, lite, 8b...) prevalgono sulla famiglia.
+MODEL_TIER_TOKENS = [
+    ({"nano", "lite", "8b", "9b", "instant", "haiku", "3.5"}, 1),
+    ({"mini", "flash", "70b"}, 2),
+    ({"pro", "opus", "sonnet", "o1", "o3"}, 3),
+]
+# Tier di famiglia (primo token) se nessun token sopra è presente
+MODEL_FAMILY_TIERS = [("gemma", 1), ("grok", 2), ("gemini", 2)]
+
+# Modelli restituiti dagli endpoint /models che non supportano la chat testuale
+NON_CHAT_PATTERNS = ["audio", "realtime", "tts", "transcribe", "whisper", "embedding",
+                     "dall-e", "image", "moderation", "search", "instruct", "vision"]
+
+def is_chat_model(model_id):
+    name = model_id.lower()
+    return not any(pattern in name for pattern in NON_CHAT_PATTERNS)
+
+def model_tier(model_id):
+    """Tier di qualità stimato dal nome del modello (0 = sconosciuto, escluso dal routing)."""
+    tokens = re.split(r"[-_/:]", model_id.lower())
+    for tier_tokens, tier in MODEL_TIER_TOKENS:
+        if any(token in tier_tokens for token in tokens):
+            return tier
+    # gpt-4, gpt-4o, gpt-4.1, chatgpt-4o-latest (le varianti mini/nano sono già coperte)
+    if tokens[0] in ("gpt", "chatgpt") and len(tokens) > 1 and tokens[1].startswith("4"):
+        return 3
+    for family, tier in MODEL_FAMILY_TIERS:
+        if tokens[0].startswith(family):
+            return tier
+    return 0
+
+
+class ModelStats:
+    """Finestra mobile di latenze ed esiti per un singolo provider/modello."""
+
+    def __init__(self, window):
+        self.latencies = {}          # task -> deque di secondi
+        self.outcomes = deque(maxlen=window)
+        self.window = window
+        self.consecutive_errors = 0
+        self.cooldown_until = 0.0
+
+    def record(self, task, latency, ok):
+        if ok:
+            self.latencies.setdefault(task, deque(maxlen=self.window)).append(latency)
+        self.outcomes.append(ok)
+        self.consecutive_errors = 0 if ok else self.consecutive_errors + 1
+
+    def latency(self, task=None):
+        samples = self.latencies.get(task)
+        if not samples:
+            samples = [s for d in self.latencies.values() for s in d]
+        if not samples:
+            return None
+        return sum(samples) / len(samples)
+
+    @property
+    def error_rate(self):
+        if not self.outcomes:
+            return 0.0
+        return 1 - sum(self.outcomes) / len(self.outcomes)
+
+
+class ModelRouter:
+    """
+    Sceglie per ogni task il modello sano più veloce che rispetta il tier minimo.
+    Le statistiche sono condivise (thread-safe); i pin per task sono opzionali.
+    """
+
+    def __init__(self, window=20, max_error_rate=0.5, min_samples=5, max_consecutive_errors=3,
+                 cooldown_s=120, unknown_latency_s=60.0, explore_budget=6, task_tiers=None):
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.min_samples = min_samples
+        self.max_consecutive_errors = max_consecutive_errors
+        self.cooldown_s = cooldown_s
+        self.unknown_latency_s = unknown_latency_s
+        # Chiamate di esplorazione per task: ogni modello non ancora misurato viene
+        # provato una volta (fino al budget) prima di affidarsi alla classifica
+        self.explore_budget = explore_budget
+        self.explored = set()    # (task, provider, model) già provati in esplorazione
+        self.task_tiers = dict(DEFAULT_TASK_TIERS, **(task_tiers or {}))
+        self.candidates = {}     # (provider, model) -> api_key
+        self.stats = {}          # (provider, model) -> ModelStats
+        self.pins = {}           # task -> (provider, model)
+        self.decisions = deque(maxlen=50)
+        self._lock = threading.Lock()
+
+    # ---------- CONFIGURAZIONE ----------
+    def set_candidates(self, provider, api_key, models):
+        """Registra i modelli di un provider (es. la lista restituita da `aiversion`)."""
+        with self._lock:
+            for key in [k for k in self.candidates if k[0] == provider]:
+                del self.candidates[key]
+            for model_id in models:
+                if (model_id and "Errore" not in model_id and "Inserisci" not in model_id
+                        and is_chat_model(model_id)):
+                    self.candidates[(provider, model_id)] = api_key
+
+    def pin(self, task, provider, model_id):
+        self.pins[task] = (provider, model_id)
+
+    def unpin(self, task):
+        self.pins.pop(task, None)
+
+    # ---------- STATISTICHE ----------
+    def _stats(self, key):
+        if key not in self.stats:
+            self.stats[key] = ModelStats(self.window)
+        return self.stats[key]
+
+    def record(self, task, provider, model_id, latency, ok):
+        with self._lock:
+            stats = self._stats((provider, model_id))
+            if ok and stats.cooldown_until:
+                # Prova dopo la pausa (o chiamata su pin) riuscita: si riparte da zero
+                stats.outcomes.clear()
+                stats.cooldown_until = 0.0
+                logger.info("Modello %s/%s di nuovo disponibile", provider, model_id)
+            stats.record(task, latency, ok)
+            too_many_errors = (len(stats.outcomes) >= self.min_samples
+                               and stats.error_rate > self.max_error_rate)
+            if not ok and (stats.consecutive_errors >= self.max_consecutive_errors or too_many_errors):
+                stats.cooldown_until = time.monotonic() + self.cooldown_s
+                logger.warning("Modello %s/%s in pausa per %ss (errori consecutivi: %s, tasso errori: %.0f%%)",
+                               provider, model_id, self.cooldown_s, stats.consecutive_errors,
+                               stats.error_rate * 100)
+
+    def is_healthy(self, provider, model_id):
+        """Sano se non è in pausa; a pausa scaduta il modello torna disponibile per una prova."""
+        stats = self.stats.get((provider, model_id))
+        return stats is None or time.monotonic() >= stats.cooldown_until
+
+    def _claim_probe(self, key):
+        """Se il modello scelto esce da una pausa, la prova è una sola: gli altri aspettano l'esito."""
+        stats = self.stats.get(key)
+        if stats and stats.cooldown_until:
+            stats.cooldown_until = time.monotonic() + self.cooldown_s
+
+    # ---------- ROUTING ----------
+    def route(self, task, fallback=None, min_tier=None, pins=None, exclude=()):
+        """
+        Restituisce (provider, model_id, api_key) per il task.
+        Ordine: pin del task → modello sano più veloce con tier sufficiente → fallback.
+        `pins` sostituisce i pin del router (es. pin per singola sessione Streamlit);
+        `exclude` elenca i (provider, model) da non scegliere (es. appena falliti).
+        """
+        pins = self.pins if pins is None else pins
+        with self._lock:
+            pinned = pins.get(task)
+            if pinned and pinned in self.candidates and pinned not in exclude:
+                choice, reason = pinned, "pin"
+            else:
+                required = max(self.task_tiers.get(task, 1), min_tier or 0)
+                eligible, untried = [], []
+                for key in self.candidates:
+                    if (key in exclude or model_tier(key[1]) < required
+                            or not self.is_healthy(*key)):
+                        continue
+                    stats = self.stats.get(key)
+                    if not (stats and stats.latencies.get(task)) and (task, *key) not in self.explored:
+                        untried.append((model_tier(key[1]), key))
+                    latency = stats.latency(task) if stats else None
+                    eligible.append((self.unknown_latency_s if latency is None else latency, key))
+                explored = sum(1 for e in self.explored if e[0] == task)
+                if untried and explored < self.explore_budget:
+                    # Modelli più economici per primi
+                    _, choice = min(untried)
+                    self.explored.add((task, *choice))
+                    reason = f"tier>={required}, esplorazione {explored + 1}/{self.explore_budget}"
+                elif eligible:
+                    latency, choice = min(eligible)
+                    reason = f"tier>={required}, latenza {latency:.1f}s"
+                elif fallback and tuple(fallback[:2]) not in exclude:
+                    choice, reason = tuple(fallback[:2]), "fallback manuale"
+                else:
+                    raise RuntimeError(f"Nessun modello disponibile per il task '{task}'")
+                self._claim_probe(choice)
+
+            api_key = self.candidates.get(choice) or (fallback[2] if fallback else None)
+            decision = {"task": task, "provider": choice[0], "model": choice[1],
+                        "reason": reason, "time": time.time()}
+            self.decisions.append(decision)
+        logger.info("Routing %s → %s/%s (%s)", task, choice[0], choice[1], reason)
+        return choice[0], choice[1], api_key
+
+    def call(self, task, prompt, history=None, json_mode=False,
+             fallback=None, min_tier=None, pins=None, session=None,
+             caller=None, limit=None):
+        """
+        Instrada la chiamata, misura latenza ed esito e aggiorna le statistiche.
+        Se il modello risponde con un errore si riprova una volta sul candidato successivo.
+        `limit(provider)` è un context manager opzionale (es. semaforo per provider):
+        l'attesa per acquisirlo non viene conteggiata come latenza del modello.
+        """
+        caller = caller or call_ai
+        failed = []
+        for attempt in range(2):
+            try:
+                provider, model_id, api_key = self.route(task, fallback=fallback, min_tier=min_tier,
+                                                         pins=pins, exclude=failed)
+            except RuntimeError:
+                if not failed:
+                    raise
+                return response
+            with limit(provider) if limit else contextlib.nullcontext():
+                started = time.monotonic()
+                response = caller(provider, model_id, api_key, prompt, history=history,
+                                  json_mode=json_mode, session=session)
+                latency = time.monotonic() - started
+            ok = not is_error_response(response)
+            self.record(task, provider, model_id, latency, ok)
+            if ok:
+                return response
+            failed.append((provider, model_id))
+            logger.warning("Errore da %s/%s per %s, tentativo %s", provider, model_id, task, attempt + 1)
+        return response
+
+    def snapshot(self):
+        """Statistiche correnti, per la UI e i log."""
+        with self._lock:
+            rows = []
+            for (provider, model_id), stats in self.stats.items():
+                latency = stats.latency()
+                rows.append({
+                    "Provider": provider,
+                    "Modello": model_id,
+                    "Tier": TIER_NAMES.get(model_tier(model_id), "-"),
+                    "Latenza media (s)": round(latency, 2) if latency is not None else None,
+                    "Errori %": round(stats.error_rate * 100),
+                    "Sano": self.is_healthy(provider, model_id),
+                })
+            return rows
@@ -0,0 +1,68 @@
+import gspread
+from oauth2client.service_account import ServiceAccountCredentials
+from datetime import datetime
+import cassette
+
+# ----------------------------------------------------------------------
+# ACCESSO A GOOGLE SHEETS (indipendente da Streamlit)
+# ----------------------------------------------------------------------
+SHEET_NAME = "TimmyWonka_DB"
+CATALOG_SHEET_TITLE = "CatalogoCompleto"
+IDEAS_HEADER = ["Titolo", "Tema", "Vibe", "Data", "Autore", "Concept"]
+
+SCOPE = ["https://spreadsheets.google.com/feeds",
+         "https://www.googleapis.com/auth/drive"]
+
+def open_worksheet(creds_dict, worksheet_index=0):
+    """
+    Apre il foglio `worksheet_index` del DB con le credenziali del service account.
+    Con una cassetta attiva restituisce un proxy che registra/riproduce le chiamate
+    (in replay non serve alcuna credenziale).
+    """
+    active = cassette.active()
+    if cassette.replaying():
+        return active.worksheet(None, worksheet_index)
+
+    creds_dict = dict(creds_dict)
+    if "\\n" in creds_dict["private_key"]:
+        creds_dict["private_key"] = creds_dict["private_key"].replace("\\n", "\n")
+    creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, SCOPE)
+    client = gspread.authorize(creds)
+    sheet = client.open(SHEET_NAME).get_worksheet(worksheet_index)
+    if active is not None and sheet is not None:
+        return active.worksheet(sheet, worksheet_index)
+    return sheet
+
+
+def catalog_titles(sheet):
+    """Righe 'Titolo: ..., Tema: ...' del Catalogo Completo."""
+    titles = sheet.col_values(1)[1:] if sheet.col_values(1) else []
+    themes = sheet.col_values(2)[1:] if sheet.col_values(2) else []
+    return [f"Titolo: {t}, Tema: {th}" for t, th in zip(titles, themes) if t and th]
+
+
+def bulk_save_ideas(sheet, ideas):
+    """
+    Scrive in un'unica chiamata le idee (title, description, vibe) non ancora presenti.
+    Restituisce il numero di righe aggiunte.
+    """
+    try:
+        titles = sheet.col_values(1)
+    except Exception:
+        titles = []
+
+    date_str = datetime.now().strftime("%Y-%m-%d %H:%M")
+    seen = set(titles)
+    rows = []
+    if not titles:
+        rows.append(IDEAS_HEADER)
+    for title, description, vibe in ideas:
+        if title in seen:
+            continue
+        seen.add(title)
+        rows.append([title, description, vibe, date_str])
+
+    new_ideas = len(rows) - (0 if titles else 1)
+    if new_ideas > 0:
+        sheet.append_rows(rows)
+    return new_ideas
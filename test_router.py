@@ -0,0 +1,59 @@
+import pytest
+
+# router importa aicall, che richiede gli SDK dei provider
+pytest.importorskip("google.generativeai")
+pytest.importorskip("openai")
+pytest.importorskip("anthropic")
+
+from router import ModelRouter, model_tier
+
+
+@pytest.mark.parametrize("model_id, tier", [
+    # Google Gemini (aiversion.get_gemini_models)
+    ("gemini-1.5-pro-latest", 3),
+    ("gemini-2.5-pro", 3),
+    ("gemini-1.5-flash", 2),
+    ("gemini-1.5-flash-8b", 1),
+    ("gemini-2.0-flash-lite", 1),
+    ("gemma-3-27b-it", 1),
+    # ChatGPT (aiversion.get_openai_models)
+    ("gpt-4o", 3),
+    ("gpt-4.1", 3),
+    ("chatgpt-4o-latest", 3),
+    ("gpt-4o-mini", 2),
+    ("gpt-4.1-nano", 1),
+    ("gpt-3.5-turbo", 1),
+    ("o1", 3),
+    ("o3-mini", 2),
+    # Claude (aiversion.get_anthropic_models)
+    ("claude-3-5-sonnet-latest", 3),
+    ("claude-3-opus-20240229", 3),
+    ("claude-3-haiku-20240307", 1),
+    # Groq (aiversion.get_groq_models)
+    ("llama-3.3-70b-versatile", 2),
+    ("llama-3.1-8b-instant", 1),
+    ("llama3-8b-8192", 1),
+    ("gemma2-9b-it", 1),
+    # Grok (xAI)
+    ("grok-beta", 2),
+    ("grok-2-1212", 2),
+])
+def test_model_tier(model_id, tier):
+    assert model_tier(model_id) == tier
+
+
+def test_route_explores_untried_models_before_ranking():
+    router = ModelRouter()
+    router.set_candidates("Groq", "k", ["llama-3.3-70b-versatile", "llama-3.1-8b-instant", "gemma2-9b-it"])
+    router.set_candidates("ChatGPT", "k", ["gpt-4o", "gpt-4o-mini"])
+    latencies = {"gpt-4o": 5, "gpt-4o-mini": 3, "llama-3.3-70b-versatile": 1.5,
+                 "llama-3.1-8b-instant": 0.5, "gemma2-9b-it": 0.4}
+
+    chosen = []
+    for _ in range(20):
+        provider, model_id, _ = router.route("concept_json")
+        router.record("concept_json", provider, model_id, latencies[model_id], True)
+        chosen.append(model_id)
+
+    assert set(chosen[:5]) == set(latencies)
+    assert set(chosen[5:]) == {"gemma2-9b-it"}